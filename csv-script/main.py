@@ -6,9 +6,35 @@ import argparse
 from enum import Enum
 import json
 import re
+import base64
+import hashlib
+import math
+import random
+import functools
+import contextlib
+import heapq
+import sys
+import tempfile
+import zlib
+import csv
+import itertools
+import decimal
+import shutil
+from collections.abc import Iterable
+from dataclasses import dataclass, field
 
 date_time_format = "%Y_%m_%d"
 
+# Денежные суммы хранятся целыми числами в единицах 10 ** -money_scale
+money_scale = 2
+
+
+class ReportError(ValueError):
+    """
+    Invalid data file, row or report argument. The message is the one
+    printed by the script.
+    """
+
 
 class Command(Enum):
     report = '--report'
@@ -19,6 +45,7 @@ class Command(Enum):
 class Operation(Enum):
     payout = 'payout'
     average_rate = 'average-rate'
+    approximate_stats = 'approximate-stats'
 
 
 operation_list = [operation.value for operation in Operation]
@@ -48,7 +75,6 @@ email_list = [e_mail.value for e_mail in EmailHeader]
 
 email_regex = r'[^@]+@[^@]+\.[^@]+'
 
-
 class DepartmentHeader(Enum):
     department = 'department'
     devision = 'devision'
@@ -90,8 +116,192 @@ class IdHeader(Enum):
 id_point_list = [id_point.value for id_point in IdHeader]
 
 
+canonical_header = ('id', 'email', 'department', 'name', 'hours', 'rate')
+
+header_aliases = {
+    **{header: 'id' for header in id_point_list},
+    **{header: 'email' for header in email_list},
+    **{header: 'department' for header in department_list},
+    **{header: 'name' for header in name_list},
+    **{header: 'hours' for header in hours_list},
+    **{header: 'rate' for header in rate_list},
+}
+
+# Кодировка файлов данных одна для обычного чтения и чтения
+# с контрольными точками
+data_file_encoding = 'utf-8'
+
+email_pattern = re.compile(email_regex)
+name_pattern = re.compile(name_regex)
+
+
+@functools.lru_cache(maxsize=256)
+def resolve_header_plan(headers: tuple) -> tuple | None:
+    """
+    Map the header of a data file to column indexes in canonical_header
+    order. The result is cached, so files with the same header are
+    resolved once per process.
+    """
+    if len(headers) != len(canonical_header):
+        return None
+    indexes = {}
+    for index, header in enumerate(headers):
+        column = header_aliases.get(header)
+        if column is None or column in indexes:
+            return None
+        indexes[column] = index
+    return tuple(indexes[column] for column in canonical_header)
+
+
+def parse_data_row(data_row: list,
+                   header_plan: tuple,
+                   file_address: str,
+                   data_row_number: int,
+                   scale: int = money_scale) -> list:
+    (id_index, email_index, department_index,
+     name_index, hours_index, rate_index) = header_plan
+    if len(data_row) != len(canonical_header):
+        raise ReportError(f"Data file {file_address} "
+                          f"row number {data_row_number} "
+                          f"content incorrect number of columns.")
+    try:
+        id_point = int(data_row[id_index])
+    except ValueError:
+        raise ReportError(f"{file_address} Id column row "
+                          f"{data_row_number} "
+                          f"should content integer")
+    if id_point < 0:
+        raise ReportError(f'{file_address} '
+                          f'Id column '
+                          f'row {data_row_number} '
+                          f'should content positive integer')
+    if not email_pattern.match(data_row[email_index]):
+        raise ReportError(f"{file_address} row {data_row_number}"
+                          f" Incorrect email address in column")
+    if not name_pattern.match(data_row[name_index]):
+        raise ReportError(f'{file_address} line {data_row_number}'
+                          'Incorrect staff name in column.'
+                          'Please, insert only letters '
+                          'in this column')
+    try:
+        hours = int(data_row[hours_index])
+    except ValueError:
+        raise ReportError(f'{file_address} line {data_row_number}'
+                          'Hours column should content integer')
+    if hours < 0:
+        raise ReportError(f"{file_address} line {data_row_number}"
+                          "Hours can't be negative number")
+    try:
+        rate = parse_money(data_row[rate_index], scale)
+    except (ArithmeticError, ValueError):
+        raise ReportError(f'{file_address} line {data_row_number}'
+                          'Rate colum should content number')
+    if rate <= 0:
+        raise ReportError(f'{file_address} line {data_row_number}'
+                          'Rate should be more than null')
+    return [id_point,
+            data_row[email_index],
+            data_row[department_index],
+            data_row[name_index],
+            hours,
+            rate]
+
+
+def parse_money(value: str, scale: int = money_scale) -> int:
+    """
+    Parse an amount to an integer number of 10 ** -scale units
+    (cents for the default scale), rounding half up.
+    """
+    amount = decimal.Decimal(value)
+    if not amount.is_finite():
+        raise ValueError(f'{value} is not a finite amount')
+    return int(amount.scaleb(scale).to_integral_value(
+        rounding=decimal.ROUND_HALF_UP
+    ))
+
+
+def format_money(amount: int, scale: int = money_scale) -> float:
+    return amount / 10 ** scale
+
+
+def divide_money(amount: int, divisor: int) -> int:
+    """
+    Divide a not negative amount, rounding half up. Zero divisor
+    gives zero.
+    """
+    if not divisor:
+        return 0
+    return (2 * amount + divisor) // (2 * divisor)
+
+
+def split_data_line(line: str) -> list[str]:
+    return line.rstrip('\r\n').split(',')
+
+
+def read_data_from_rows(rows: Iterable,
+                        file_address: str,
+                        raw_table: list,
+                        scale: int = money_scale) -> list:
+    """
+    Validate split rows (the first one is the header) and append them
+    to raw_table in canonical_header order, with rates in 10 ** -scale
+    units. Invalid data raises ReportError.
+    """
+    rows = iter(rows)
+    header_plan = resolve_header_plan(tuple(next(rows, ())))
+    if header_plan is None:
+        raise ReportError(read_data_from_data_files.__doc__)
+    for data_row_number, data_row in enumerate(rows, start=1):
+        raw_table.append(parse_data_row(data_row,
+                                        header_plan,
+                                        file_address,
+                                        data_row_number,
+                                        scale))
+    return raw_table
+
+
+def read_data_from_lines(lines: Iterable[str],
+                         file_address: str,
+                         raw_table: list,
+                         scale: int = money_scale) -> list:
+    return read_data_from_rows(
+        (split_data_line(line) for line in lines),
+        file_address,
+        raw_table,
+        scale
+    )
+
+
+def read_data_from_path(data_file: str | os.PathLike,
+                        raw_table: list,
+                        scale: int = money_scale) -> list:
+    try:
+        # Строки делятся только по \n, как при чтении в байтах
+        # с контрольными точками
+        with open(data_file, mode='r', encoding=data_file_encoding,
+                  newline='\n') as file:
+            return read_data_from_lines(file,
+                                        os.path.abspath(data_file),
+                                        raw_table,
+                                        scale)
+    except FileNotFoundError:
+        raise ReportError(f"{os.path.abspath(data_file)} not found.")
+    except UnicodeDecodeError:
+        raise ReportError(f'{os.path.abspath(data_file)} should be '
+                          f'{data_file_encoding} text')
+
+
+def read_raw_table(data_files: list[str],
+                   scale: int = money_scale) -> list:
+    raw_table = [list(canonical_header)]
+    for data_file in data_files:
+        read_data_from_path(data_file, raw_table, scale)
+    return raw_table
+
+
 async def read_data_from_data_files(
-        data_files: list[str] | None = None
+        data_files: list[str] | None = None,
+        scale: int = money_scale
 ) -> list | None:
     """
     The table should content following header:
@@ -105,105 +315,301 @@ async def read_data_from_data_files(
     """
     if data_files is None:
         return
-    raw_table = []
-    header_row = ['id', 'email', 'department', 'name', 'hours', 'rate']
-    raw_table.append(header_row)
-    for data_file in data_files:
-        try:
-            with open(data_file, mode='r') as file:
-                file_address = os.path.abspath(data_file)
-                headers = file.readline()
-                headers = headers.replace('\n', '')
-                headers = headers.split(',')
-                if len(headers) != len(header_row):
-                    return print(read_data_from_data_files.__doc__)
-                check_set = set()
-                for header in headers:
-                    if header in id_point_list:
-                        id_index = headers.index(header)
-                        id_header = 'id'
-                        check_set.add(id_header)
-                    elif header in email_list:
-                        email_index = headers.index(header)
-                        email_header = 'email'
-                        check_set.add(email_header)
-                    elif header in department_list:
-                        department_index = headers.index(header)
-                        dep_header = 'department'
-                        check_set.add(dep_header)
-                    elif header in name_list:
-                        name_index = headers.index(header)
-                        name_header = 'name'
-                        check_set.add(name_header)
-                    elif header in hours_list:
-                        hours_index = headers.index(header)
-                        hour_header = 'hour'
-                        check_set.add(hour_header)
-                    elif header in rate_list:
-                        rate_index = headers.index(header)
-                        rate_header = 'rate'
-                        check_set.add(rate_header)
-                    else:
-                        return print(read_data_from_data_files.__doc__)
-                if len(headers) != len(check_set):
-                    return print(read_data_from_data_files.__doc__)
-                data_rows = file.readlines()
-                for data_row in data_rows:
-                    data_row_number = data_row.index(data_row) + 1
-                    raw_table_new_line = []
-                    data_row = data_row.replace('\n', '')
-                    data_row = data_row.split(',')
-                    if len(data_row) != len(header_row):
-                        return print(f"Data file {file_address} "
-                                     f"row number {data_row_number} "
-                                     f"content incorrect number of columns.")
-                    try:
-                        int(data_row[id_index])
-                    except ValueError:
-                        return print(f"{file_address} Id column row "
-                                     f"{data_row_number} "
-                                     f"should content integer")
-                    if int(data_row[id_index]) < 0:
-                        return print(f'{file_address} '
-                                     f'Id column '
-                                     f'row {data_row_number} '
-                                     f'should content positive integer')
-                    if not re.match(email_regex, data_row[email_index]):
-                        return print(f"{file_address} row {data_row_number}"
-                                     f" Incorrect email address in column")
-                    if not re.match(name_regex, data_row[name_index]):
-                        return print(f'{file_address} line {data_row_number}'
-                                     'Incorrect staff name in column.'
-                                     'Please, insert only letters '
-                                     'in this column')
-                    try:
-                        int(data_row[hours_index])
-                    except ValueError:
-                        return print(f'{file_address} line {data_row_number}'
-                                     'Hours column should content integer')
-                    if int(data_row[hours_index]) < 0:
-                        return print(f"{file_address} line {data_row_number}"
-                                     "Hours can't be negative number")
-                    try:
-                        float(data_row[rate_index])
-                    except ValueError:
-                        return print(f'{file_address} line {data_row_number}'
-                                     'Rate colum should content number')
-                    if float(data_row[rate_index]) <= 0:
-                        return print(f'{file_address} line {data_row_number}'
-                                     'Rate should be more than null')
-                    raw_table_new_line.append(int(data_row[id_index]))
-                    raw_table_new_line.append(data_row[email_index])
-                    raw_table_new_line.append(data_row[department_index])
-                    raw_table_new_line.append(data_row[name_index])
-                    raw_table_new_line.append(int(data_row[hours_index]))
-                    raw_table_new_line.append(
-                        round(float(data_row[rate_index]), 2)
-                    )
-                    raw_table.append(raw_table_new_line)
-        except FileNotFoundError:
-            return print(f"{os.path.abspath(data_file)} not found.")
-    return raw_table
+    try:
+        return read_raw_table(data_files, scale)
+    except ReportError as error:
+        return print(error)
+
+
+hll_precision = 12
+kll_k = 200
+
+
+def hll_sigma(share: float) -> float:
+    if share == 1:
+        return math.inf
+    power = 1
+    result = share
+    while True:
+        share *= share
+        previous = result
+        result += share * power
+        power += power
+        if result == previous:
+            return result
+
+
+def hll_tau(share: float) -> float:
+    if share in (0, 1):
+        return 0
+    power = 1
+    result = 1 - share
+    while True:
+        share = math.sqrt(share)
+        previous = result
+        power *= 0.5
+        result -= (1 - share) ** 2 * power
+        if result == previous:
+            return result / 3
+
+
+class HyperLogLog:
+    """
+    Approximate count of distinct values kept in 2 ** precision one-byte
+    registers. The count uses the improved estimator of O. Ertl
+    (arXiv:1702.01284), which has no bias on small and middle sets,
+    so there is no switch to linear counting. The relative standard
+    error is about 1.04 / sqrt(2 ** precision): ~1.6% for the default
+    precision 12, which takes 4 KiB no matter how many values were added.
+    Sketches with the same precision merge without any loss.
+    """
+
+    def __init__(self, precision: int = hll_precision):
+        if not 4 <= precision <= 16:
+            raise ValueError('HyperLogLog precision should be from 4 to 16')
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value: str) -> None:
+        hashed = int.from_bytes(
+            hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big'
+        )
+        bits = 64 - self.precision
+        index = hashed >> bits
+        rank = bits - (hashed & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: 'HyperLogLog') -> None:
+        if other.precision != self.precision:
+            raise ValueError('Only sketches with the same precision '
+                             'can be merged')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        registers_count = len(self.registers)
+        bits = 64 - self.precision
+        histogram = [0] * (bits + 2)
+        for register in self.registers:
+            histogram[register] += 1
+        denominator = registers_count * hll_tau(
+            1 - histogram[bits + 1] / registers_count
+        )
+        for rank in range(bits, 0, -1):
+            denominator = 0.5 * (denominator + histogram[rank])
+        denominator += registers_count * hll_sigma(
+            histogram[0] / registers_count
+        )
+        return round(registers_count ** 2 / (2 * math.log(2)) / denominator)
+
+    def to_dict(self) -> dict:
+        return dict(precision=self.precision,
+                    registers=base64.b64encode(self.registers).decode())
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'HyperLogLog':
+        sketch = cls(data['precision'])
+        registers = base64.b64decode(data['registers'])
+        if len(registers) != len(sketch.registers):
+            raise ValueError('HyperLogLog registers do not match precision')
+        sketch.registers = bytearray(registers)
+        return sketch
+
+
+class KLLSketch:
+    """
+    Mergeable quantile sketch (Karnin, Lang, Liberty). Values are kept
+    in levels of sorted compactors, a value on level h stands for 2 ** h
+    original values, so the sketch holds at most about 3 * k values.
+    With the default k = 200 a returned quantile is within ~1.7% of the
+    requested rank with 99% confidence. Below k values it is exact.
+    """
+
+    def __init__(self, k: int = kll_k, seed: int | None = 0):
+        if k < 8:
+            raise ValueError('KLL sketch k should be at least 8')
+        self.k = k
+        self.compactors = [[]]
+        self.size = 0
+        self.max_size = self._capacity(0)
+        self.random = random.Random(seed)
+
+    def _capacity(self, level: int) -> int:
+        depth = len(self.compactors) - level - 1
+        return max(2, math.ceil(self.k * (2 / 3) ** depth))
+
+    def _grow(self) -> None:
+        self.compactors.append([])
+        self.max_size = sum(
+            self._capacity(level) for level in range(len(self.compactors))
+        )
+
+    def _compress(self) -> None:
+        while self.size >= self.max_size:
+            for level, compactor in enumerate(self.compactors):
+                if len(compactor) < self._capacity(level):
+                    continue
+                if level + 1 == len(self.compactors):
+                    self._grow()
+                compactor.sort()
+                kept = [compactor.pop()] if len(compactor) % 2 else []
+                offset = self.random.randint(0, 1)
+                self.compactors[level + 1].extend(compactor[offset::2])
+                compactor[:] = kept
+                break
+            self.size = sum(len(compactor) for compactor in self.compactors)
+
+    def add(self, value: float) -> None:
+        self.compactors[0].append(value)
+        self.size += 1
+        if self.size >= self.max_size:
+            self._compress()
+
+    def merge(self, other: 'KLLSketch') -> None:
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for level, compactor in enumerate(other.compactors):
+            self.compactors[level].extend(compactor)
+        self.size = sum(len(compactor) for compactor in self.compactors)
+        self._compress()
+
+    def quantile(self, rank: float) -> float | None:
+        weighted = sorted(
+            (value, 1 << level)
+            for level, compactor in enumerate(self.compactors)
+            for value in compactor
+        )
+        if not weighted:
+            return None
+        target = rank * sum(weight for _, weight in weighted)
+        cumulative = 0
+        for value, weight in weighted:
+            cumulative += weight
+            if cumulative >= target:
+                return value
+        return weighted[-1][0]
+
+    def to_dict(self) -> dict:
+        return dict(k=self.k, compactors=self.compactors)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'KLLSketch':
+        sketch = cls(data['k'])
+        sketch.compactors = [[]]
+        for _ in range(len(data['compactors']) - 1):
+            sketch._grow()
+        for level, compactor in enumerate(data['compactors']):
+            sketch.compactors[level].extend(compactor)
+        sketch.size = sum(len(compactor) for compactor in sketch.compactors)
+        sketch._compress()
+        return sketch
+
+
+class DepartmentSketch:
+    """
+    Fixed-size statistics of one department: distinct staff emails
+    and hourly rate quantiles.
+    """
+
+    def __init__(self, staff: HyperLogLog | None = None,
+                 rates: KLLSketch | None = None):
+        self.staff = staff if staff is not None else HyperLogLog()
+        self.rates = rates if rates is not None else KLLSketch()
+
+    def add(self, email: str, rate: int) -> None:
+        self.staff.add(email)
+        self.rates.add(rate)
+
+    def merge(self, other: 'DepartmentSketch') -> None:
+        self.staff.merge(other.staff)
+        self.rates.merge(other.rates)
+
+    def to_dict(self) -> dict:
+        return dict(staff=self.staff.to_dict(), rates=self.rates.to_dict())
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'DepartmentSketch':
+        return cls(HyperLogLog.from_dict(data['staff']),
+                   KLLSketch.from_dict(data['rates']))
+
+
+class DepartmentSketchAggregator:
+    """
+    Department sketches filled row by row. Rows are passed to append
+    like to raw_table, so files can be read by read_data_from_path
+    without keeping their rows in memory.
+    """
+
+    def __init__(self):
+        self.departments = {}
+
+    def append(self, row: list) -> None:
+        sketch = self.departments.get(row[2])
+        if sketch is None:
+            sketch = self.departments[row[2]] = DepartmentSketch()
+        sketch.add(row[1], row[5])
+
+
+def build_department_sketches(raw_table: list) -> dict:
+    aggregator = DepartmentSketchAggregator()
+    for row in range(1, len(raw_table)):
+        aggregator.append(raw_table[row])
+    return aggregator.departments
+
+
+def merge_department_sketches(department_sketches: dict,
+                              other_sketches: dict) -> dict:
+    """
+    Merge sketches of other files or workers into department_sketches.
+    """
+    for department, sketch in other_sketches.items():
+        if department in department_sketches:
+            department_sketches[department].merge(sketch)
+        else:
+            department_sketches[department] = sketch
+    return department_sketches
+
+
+def load_department_sketches(data: dict) -> dict:
+    """
+    Restore sketches from an approximate-stats JSON report.
+    """
+    department_sketches = {}
+    for department in data[Operation.approximate_stats.value]:
+        department_sketches[department['department']] = \
+            DepartmentSketch.from_dict(department['sketch'])
+    return department_sketches
+
+
+def approximate_stats_report(department_sketches: dict,
+                             scale: int = money_scale) -> tuple[dict, list]:
+    department_dict_list = department_sketches_to_dict_list(
+        department_sketches, scale
+    )
+    processed_table = [
+        ['department', 'distinct_staff', 'rate_median', 'rate_p90']
+    ]
+    for department in department_dict_list:
+        processed_table.append([department['department'],
+                                department['distinct_staff'],
+                                department['rate_median'],
+                                department['rate_p90']])
+    return ({Operation.approximate_stats.value: department_dict_list},
+            processed_table)
+
+
+def department_sketches_to_dict_list(department_sketches: dict,
+                                     scale: int = money_scale) -> list:
+    department_dict_list = []
+    for department, sketch in department_sketches.items():
+        department_dict_list.append(dict(
+            department=department,
+            distinct_staff=sketch.staff.count(),
+            rate_median=format_money(sketch.rates.quantile(0.5), scale),
+            rate_p90=format_money(sketch.rates.quantile(0.9), scale),
+            sketch=sketch.to_dict()
+        ))
+    return department_dict_list
 
 
 def check_unique_element_in_process_list(
@@ -218,9 +624,523 @@ def check_unique_element_in_process_list(
     return element_count
 
 
-async def process_raw_data_table_to_dict(
+spill_partitions = 32
+max_partition_depth = 4
+# Наибольшее число одновременно открытых частей при разбиении и слиянии
+max_open_runs = 64
+
+
+class StaffAggregator:
+    """
+    Hash aggregation of staff rows by department, email and rate:
+    hours of rows with the same key are summed, id and name are taken
+    from the first row. Department totals are summed in the order of
+    rows. Rows are passed to append like to raw_table, so the aggregator
+    can be filled by read_data_from_rows without keeping the rows.
+
+    When max_memory (bytes) is set and the estimated size of the groups
+    exceeds it, the groups are spilled to files partitioned by
+    department and email (in spill_dir or in a temporary directory),
+    and aggregated partition by partition in iter_staff. The result is
+    the same as without the limit. Rates and payouts are kept in
+    10 ** -scale units.
+    """
+
+    def __init__(self, max_memory: int | None = None,
+                 partitions: int = spill_partitions,
+                 spill_dir: str | None = None,
+                 scale: int = money_scale):
+        self.max_memory = max_memory
+        self.partitions = partitions
+        self.spill_dir = spill_dir
+        self.scale = scale
+        self.temporary_dir = None
+        self.groups = {}
+        self.departments = {}
+        self.memory = 0
+        self.sequence = 0
+        self.spill_files = []
+        self.run_files = []
+
+    def append(self, row: list) -> None:
+        id_point, email, department, name, hours, rate = row
+        totals = self.departments.get(department)
+        if totals is None:
+            totals = self.departments[department] = [
+                len(self.departments), 0, 0
+            ]
+        totals[1] += hours
+        totals[2] += hours * rate
+        key = (department, email, rate)
+        group = self.groups.get(key)
+        if group is None:
+            self.groups[key] = [self.sequence, id_point, name, hours]
+            self.memory += group_memory_size(key, name)
+            if self.max_memory is not None \
+                    and self.memory > self.max_memory:
+                self.spill()
+        else:
+            group[3] += hours
+        self.sequence += 1
+
+    def _open_spill_files(self, mode: str) -> None:
+        if self.spill_dir is None:
+            self.temporary_dir = tempfile.TemporaryDirectory(
+                prefix='csv_script_'
+            )
+            self.spill_dir = self.temporary_dir.name
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self.spill_files = [
+            open(os.path.join(self.spill_dir, f'{partition}.jsonl'),
+                 mode=mode)
+            for partition in range(self.partitions)
+        ]
+
+    def spill(self) -> None:
+        if not self.spill_files:
+            self._open_spill_files('w+')
+        for (department, email, rate), group in self.groups.items():
+            partition = zlib.crc32(
+                f'{department},{email}'.encode()
+            ) % self.partitions
+            self.spill_files[partition].write(
+                json.dumps([department, email, rate, *group]) + '\n'
+            )
+        self.groups.clear()
+        self.memory = 0
+
+    def _sorted_groups(self, groups: dict) -> list:
+        return sorted(
+            ([self.departments[key[0]][0], *group, *key]
+             for key, group in groups.items()),
+            key=lambda item: item[:2]
+        )
+
+    def _partition_runs(self, spill_file: Any, name: str,
+                        depth: int = 0) -> list:
+        """
+        Aggregate one spilled partition into a sorted run file and return
+        the paths of run files. When the groups of the partition exceed
+        max_memory, the partition is split by another hash of department
+        and email into at most max_open_runs parts, and every part is
+        aggregated the same way.
+        """
+        spill_file.seek(0)
+        groups = {}
+        memory = 0
+        read_size = 0
+        for line in spill_file:
+            department, email, rate, sequence, id_point, name_value, hours = \
+                json.loads(line)
+            read_size += len(line)
+            group = groups.get((department, email, rate))
+            # Части сбрасываются по порядку строк, поэтому первая
+            # запись группы содержит её первую строку
+            if group is None:
+                groups[(department, email, rate)] = [
+                    sequence, id_point, name_value, hours
+                ]
+                memory += group_memory_size((department, email, rate),
+                                            name_value)
+                if self.max_memory is not None \
+                        and memory > self.max_memory \
+                        and depth < max_partition_depth:
+                    groups.clear()
+                    return self._split_partition(spill_file, name, depth,
+                                                 read_size)
+            else:
+                group[3] += hours
+        # Отсортированные части пишутся в отдельные файлы, чтобы
+        # не испортить файлы, на которые ссылается контрольная точка
+        run_path = os.path.join(self.spill_dir, f'{name}.run.jsonl')
+        with open(run_path, mode='w') as run_file:
+            for item in self._sorted_groups(groups):
+                run_file.write(json.dumps(item) + '\n')
+        self.run_files.append(run_path)
+        return [run_path]
+
+    def _split_partition(self, spill_file: Any, name: str, depth: int,
+                         read_size: int) -> list:
+        spill_file.seek(0, os.SEEK_END)
+        # Частей столько, чтобы каждая заняла около половины бюджета
+        parts = min(max_open_runs,
+                    max(2, math.ceil(2 * spill_file.tell() / read_size)))
+        part_paths = [os.path.join(self.spill_dir, f'{name}.{part}.jsonl')
+                      for part in range(parts)]
+        part_files = [open(part_path, mode='w+')
+                      for part_path in part_paths]
+        spill_file.seek(0)
+        for line in spill_file:
+            department, email = json.loads(line)[:2]
+            part = zlib.crc32(
+                f'{depth + 1},{department},{email}'.encode()
+            ) % parts
+            part_files[part].write(line)
+        runs = []
+        for part, part_file in enumerate(part_files):
+            runs += self._partition_runs(part_file, f'{name}.{part}',
+                                         depth + 1)
+            part_file.close()
+            os.remove(part_paths[part])
+        return runs
+
+    def _merge_run_files(self, run_paths: list) -> Iterable:
+        with contextlib.ExitStack() as stack:
+            run_files = [stack.enter_context(open(run_path, mode='r'))
+                         for run_path in run_paths]
+            yield from heapq.merge(
+                *run_files, key=lambda line: json.loads(line)[:2]
+            )
+
+    def _iter_sorted_spilled_groups(self) -> Iterable:
+        self.spill()
+        run_paths = []
+        for partition, spill_file in enumerate(self.spill_files):
+            run_paths += self._partition_runs(spill_file, str(partition))
+        # Части сливаются проходами не больше чем по max_open_runs файлов,
+        # чтобы не упереться в ограничение числа открытых файлов
+        merge_pass = 0
+        while len(run_paths) > max_open_runs:
+            merged_paths = []
+            for start in range(0, len(run_paths), max_open_runs):
+                merged_path = os.path.join(
+                    self.spill_dir, f'merge.{merge_pass}.{start}.jsonl'
+                )
+                with open(merged_path, mode='w') as merged_file:
+                    merged_file.writelines(self._merge_run_files(
+                        run_paths[start:start + max_open_runs]
+                    ))
+                merged_paths.append(merged_path)
+            for run_path in run_paths:
+                os.remove(run_path)
+            run_paths = merged_paths
+            merge_pass += 1
+        return map(json.loads, self._merge_run_files(run_paths))
+
+    def iter_staff(self) -> Iterable:
+        """
+        Yield department and staff dict pairs in order of the first
+        row of the department and of the employee.
+        """
+        if not self.spill_files:
+            sorted_groups = self._sorted_groups(self.groups)
+        else:
+            sorted_groups = self._iter_sorted_spilled_groups()
+        for _, _, id_point, name, hours, department, email, rate \
+                in sorted_groups:
+            yield department, dict(id=id_point,
+                                   email=email,
+                                   name=name,
+                                   hours=hours,
+                                   rate=rate)
+
+    def department_totals(self, department: str,
+                          operation: str | None) -> dict:
+        _, hours, payout = self.departments[department]
+        totals = dict(hours=hours, payout=payout)
+        if operation == Operation.average_rate.value:
+            totals['average_rate'] = divide_money(payout, hours)
+        return totals
+
+    def state(self) -> dict:
+        """
+        JSON-serializable state for a checkpoint. The groups are spilled
+        first and the partitions are referenced by their sizes, so every
+        checkpoint writes only the groups added since the previous one.
+        """
+        self.spill()
+        spilled = []
+        for spill_file in self.spill_files:
+            spill_file.flush()
+            os.fsync(spill_file.fileno())
+            spilled.append(spill_file.tell())
+        return dict(
+            departments=self.departments,
+            sequence=self.sequence,
+            spilled=spilled
+        )
+
+    @classmethod
+    def from_state(cls, state: dict,
+                   max_memory: int | None = None,
+                   partitions: int = spill_partitions,
+                   spill_dir: str | None = None,
+                   scale: int = money_scale) -> 'StaffAggregator':
+        aggregator = cls(max_memory, partitions, spill_dir, scale)
+        aggregator.departments = state['departments']
+        aggregator.sequence = state['sequence']
+        aggregator._open_spill_files('a+')
+        for spill_file, size in zip(aggregator.spill_files,
+                                    state['spilled']):
+            spill_file.truncate(size)
+            spill_file.seek(size)
+        return aggregator
+
+    def close(self) -> None:
+        for spill_file in self.spill_files:
+            spill_file.close()
+        self.spill_files = []
+        self.run_files = []
+        if self.temporary_dir is not None:
+            self.temporary_dir.cleanup()
+            self.temporary_dir = None
+            self.spill_dir = None
+
+
+checkpoint_file_name = 'checkpoint.json'
+checkpoint_rows = 100000
+
+
+def write_checkpoint(state_dir: str, checkpoint: dict) -> None:
+    """
+    Write the checkpoint to a temporary file and replace the previous
+    one with it, so an interruption never leaves a broken checkpoint.
+    """
+    checkpoint_path = os.path.join(state_dir, checkpoint_file_name)
+    with open(f'{checkpoint_path}.tmp', mode='w') as file:
+        json.dump(checkpoint, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(f'{checkpoint_path}.tmp', checkpoint_path)
+
+
+def read_checkpoint(state_dir: str) -> dict | None:
+    try:
+        with open(os.path.join(state_dir, checkpoint_file_name),
+                  mode='r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return
+
+
+def clear_checkpoint(state_dir: str) -> None:
+    shutil.rmtree(os.path.join(state_dir, 'spill'), ignore_errors=True)
+    try:
+        os.remove(os.path.join(state_dir, checkpoint_file_name))
+    except FileNotFoundError:
+        pass
+
+
+def read_data_with_checkpoints(data_file: str,
+                               aggregator: StaffAggregator,
+                               checkpoint: dict,
+                               state_dir: str,
+                               checkpoint_every: int) -> bool | None:
+    try:
+        with open(data_file, mode='rb') as file:
+            header_plan = resolve_header_plan(tuple(split_data_line(
+                file.readline().decode(data_file_encoding)
+            )))
+            if header_plan is None:
+                return print(read_data_from_data_files.__doc__)
+            if checkpoint['offset']:
+                file.seek(checkpoint['offset'])
+            rows = 0
+            for line in file:
+                checkpoint['row_number'] += 1
+                aggregator.append(parse_data_row(
+                    split_data_line(line.decode(data_file_encoding)),
+                    header_plan,
+                    data_file,
+                    checkpoint['row_number'],
+                    aggregator.scale
+                ))
+                rows += 1
+                if rows % checkpoint_every == 0:
+                    checkpoint['offset'] = file.tell()
+                    write_checkpoint(state_dir, dict(
+                        checkpoint, aggregator=aggregator.state()
+                    ))
+    except FileNotFoundError:
+        return print(f"{data_file} not found.")
+    except UnicodeDecodeError:
+        return print(f'{data_file} should be {data_file_encoding} text')
+    except ReportError as error:
+        return print(error)
+    return True
+
+
+def data_file_stats(data_files: list[str]) -> list:
+    """
+    Size and modification time of every data file, so a checkpoint is
+    not applied to changed or replaced files.
+    """
+    stats = []
+    for data_file in data_files:
+        try:
+            file_stat = os.stat(data_file)
+        except FileNotFoundError:
+            stats.append(None)
+        else:
+            stats.append([file_stat.st_size, file_stat.st_mtime_ns])
+    return stats
+
+
+def aggregate_with_checkpoints(data_files: list[str],
+                               operation: str,
+                               state_dir: str,
+                               resume: bool = False,
+                               checkpoint_every: int = checkpoint_rows,
+                               max_memory: int | None = None,
+                               scale: int = money_scale
+                               ) -> StaffAggregator | None:
+    """
+    Aggregate staff of data files, writing a checkpoint to state_dir
+    every checkpoint_every rows and after every file. The checkpoint
+    keeps the aggregator state, completed files and the byte offset in
+    the current file, so a resumed job re-reads at most checkpoint_every
+    rows. The job is not resumed if any data file has changed since the
+    checkpoint.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    spill_dir = os.path.join(state_dir, 'spill')
+    data_files = [os.path.abspath(data_file) for data_file in data_files]
+    file_stats = data_file_stats(data_files)
+    checkpoint = read_checkpoint(state_dir) if resume else None
+    if checkpoint is None:
+        aggregator = StaffAggregator(max_memory, spill_dir=spill_dir,
+                                     scale=scale)
+        checkpoint = dict(operation=operation,
+                          data_files=data_files,
+                          file_stats=file_stats,
+                          money_scale=scale,
+                          completed_files=[],
+                          offset=0,
+                          row_number=0)
+    elif checkpoint['operation'] != operation \
+            or checkpoint['data_files'] != data_files \
+            or checkpoint['money_scale'] != scale:
+        return print(f'Checkpoint in {os.path.abspath(state_dir)} '
+                     f'belongs to another job')
+    elif checkpoint['file_stats'] != file_stats:
+        return print(f'Data files have changed since the checkpoint in '
+                     f'{os.path.abspath(state_dir)}, the job can not be '
+                     f'resumed')
+    else:
+        aggregator = StaffAggregator.from_state(checkpoint.pop('aggregator'),
+                                                max_memory,
+                                                spill_dir=spill_dir,
+                                                scale=scale)
+    for data_file in data_files[len(checkpoint['completed_files']):]:
+        if read_data_with_checkpoints(data_file,
+                                      aggregator,
+                                      checkpoint,
+                                      state_dir,
+                                      checkpoint_every) is None:
+            aggregator.close()
+            return
+        checkpoint['completed_files'].append(data_file)
+        checkpoint['offset'] = 0
+        checkpoint['row_number'] = 0
+        write_checkpoint(state_dir, dict(checkpoint,
+                                         aggregator=aggregator.state()))
+    return aggregator
+
+
+def group_memory_size(key: tuple, name: str) -> int:
+    # Ключ, список группы и запись в словаре
+    return (sys.getsizeof(key) + sum(map(sys.getsizeof, key))
+            + sys.getsizeof(name) + 120)
+
+
+def format_staff(staff: dict, scale: int = money_scale) -> dict:
+    staff['payout'] = format_money(staff['hours'] * staff['rate'], scale)
+    staff['rate'] = format_money(staff['rate'], scale)
+    return staff
+
+
+def format_department_totals(totals: dict,
+                             scale: int = money_scale) -> dict:
+    totals['payout'] = format_money(totals['payout'], scale)
+    if 'average_rate' in totals:
+        totals['average_rate'] = format_money(totals['average_rate'],
+                                              scale)
+    return totals
+
+
+def iter_department_reports(aggregator: StaffAggregator,
+                            operation: str) -> Iterable:
+    department_report = None
+    for department, staff in aggregator.iter_staff():
+        if department_report is None \
+                or department_report['department'] != department:
+            if department_report is not None:
+                department_report.update(format_department_totals(
+                    aggregator.department_totals(
+                        department_report['department'], operation
+                    ),
+                    aggregator.scale
+                ))
+                yield department_report
+            department_report = dict(department=department, staff=[])
+        department_report['staff'].append(format_staff(staff,
+                                                       aggregator.scale))
+    if department_report is not None:
+        department_report.update(format_department_totals(
+            aggregator.department_totals(
+                department_report['department'], operation
+            ),
+            aggregator.scale
+        ))
+        yield department_report
+
+
+def write_aggregated_report(aggregator: StaffAggregator,
+                            operation: str,
+                            directory: str = '.') -> str:
+    """
+    Stream the payout or average-rate report to the JSON file one
+    employee at a time. The file is the same as written by
+    write_data_to_file for the in-memory report.
+    """
+    file_path = report_file_path(operation, directory)
+    with open(file_path, mode='w') as file:
+        file.write('{' + json.dumps(operation) + ': [')
+        current_department = None
+        for department, staff in aggregator.iter_staff():
+            if department != current_department:
+                if current_department is not None:
+                    file.write('], ' + json.dumps(format_department_totals(
+                        aggregator.department_totals(current_department,
+                                                     operation),
+                        aggregator.scale
+                    ))[1:-1] + '}, ')
+                file.write('{"department": ' + json.dumps(department)
+                           + ', "staff": [')
+                current_department = department
+            else:
+                file.write(', ')
+            file.write(json.dumps(format_staff(staff, aggregator.scale)))
+        if current_department is not None:
+            file.write('], ' + json.dumps(format_department_totals(
+                aggregator.department_totals(current_department, operation),
+                aggregator.scale
+            ))[1:-1] + '}')
+        file.write(']}')
+    return file_path
+
+
+def aggregated_report_table(aggregator: StaffAggregator,
+                            operation: str) -> list:
+    headers = ['department', 'hours', 'payout']
+    if operation == Operation.average_rate.value:
+        headers.append(operation)
+    processed_table = [headers]
+    for department in aggregator.departments:
+        processed_table.append([
+            department,
+            *format_department_totals(
+                aggregator.department_totals(department, operation),
+                aggregator.scale
+            ).values()
+        ])
+    return processed_table
+
+
+def raw_data_table_to_dict(
         raw_table: list,
-        operation: str | None = None
+        operation: str | None = None,
+        scale: int = money_scale
 ) -> dict | None:
     if operation is None:
         dict_list = []
@@ -231,200 +1151,127 @@ async def process_raw_data_table_to_dict(
                              department=raw_table[row][2],
                              name=raw_table[row][3],
                              hours=raw_table[row][4],
-                             rate=raw_table[row][5])
+                             rate=format_money(raw_table[row][5], scale))
             dict_list.append(data_dict)
         process_dict = {'raw_table': dict_list}
     else:
-        process_table = []
+        aggregator = StaffAggregator(scale=scale)
+        for row in range(1, len(raw_table)):
+            aggregator.append(raw_table[row])
+        raw_table.pop(0)
         department_dict_list = []
         process_dict = {operation: department_dict_list}
-        headers_row = raw_table.pop(0)
-        process_table.append(headers_row)
-        for row in range(len(raw_table)):
-            blank_list = []
-            id_name = raw_table[row][0]
-            blank_list.append(id_name)
-            e_mail = raw_table[row][1]
-            check_email = check_unique_element_in_process_list(process_table,
-                                                               e_mail,
-                                                               1)
-            blank_list.append(e_mail)
-            department = raw_table[row][2]
-            check_department = check_unique_element_in_process_list(
-                process_table,
-                department,
-                2
-            )
-            blank_list.append(department)
-            name = raw_table[row][3]
-            blank_list.append(name)
-            hours = raw_table[row][4]
-            blank_list.append(hours)
-            rate = raw_table[row][5]
-            blank_list.append(rate)
-            staff = []
-            if check_department == 0:
+        for department, staff in aggregator.iter_staff():
+            if not department_dict_list \
+                    or department_dict_list[-1]['department'] != department:
                 department_dict_list.append(dict(department=department,
-                                                 staff=staff))
-                staff.append(dict(id=id_name,
-                                  email=e_mail,
-                                  name=name,
-                                  hours=hours,
-                                  rate=rate))
-            else:
-                if check_email == 0:
-                    for i in range(len(department_dict_list)):
-                        if department_dict_list[i]['department'] == department:
-                            department_dict_list[i]['staff'].append(dict(
-                                id=id_name,
-                                email=e_mail,
-                                name=name,
-                                hours=hours,
-                                rate=rate
-                            ))
-                else:
-                    for i in range(len(department_dict_list)):
-                        if department_dict_list[i]['department']\
-                                == department:
-                            for e in range(
-                                    len(department_dict_list[i]['staff'])
-                            ):
-                                employee = department_dict_list[i]['staff']
-                                if employee[e]['email']\
-                                        == e_mail:
-                                    if employee[e]['rate']\
-                                            != rate:
-                                        employee.append(
-                                            dict(id=id_name,
-                                                 email=e_mail,
-                                                 name=name,
-                                                 hours=hours,
-                                                 rate=rate)
-                                        )
-                                    else:
-                                        employee[e]['hours'] += hours
-            process_table.append(blank_list)
+                                                 staff=[]))
+            staff['rate'] = format_money(staff['rate'], scale)
+            department_dict_list[-1]['staff'].append(staff)
     return process_dict
 
 
-async def save_data_to_file(data: Any,
-                            operation: str | None) -> None:
+async def process_raw_data_table_to_dict(
+        raw_table: list,
+        operation: str | None = None,
+        scale: int = money_scale
+) -> dict | None:
+    return raw_data_table_to_dict(raw_table, operation, scale)
+
+
+def report_file_path(operation: str | None,
+                     directory: str = '.',
+                     extension: str = 'json') -> str:
     today = datetime.now(timezone.utc).strftime(date_time_format)
     if operation is None:
-        with open(
-                f'raw_{today}.json', mode='w'
-        ) as file:
-            json.dump(data, file)
-    else:
-        with open(
-                f'{operation}_{today}.json', mode='w'
-        ) as file:
-            json.dump(data, file)
+        return os.path.join(directory, f'raw_{today}.{extension}')
+    return os.path.join(directory, f'{operation}_{today}.{extension}')
 
 
-async def process_raw_table_to_processed_table(raw_table: list,
-                                               operation: str | None) -> list:
-    to_dict_table = raw_table.copy()
-    operation_dict = await process_raw_data_table_to_dict(
-        to_dict_table, operation
-    )
-    if operation is None:
-        pass
-    else:
-        oper_dep_dict_list = operation_dict[operation]
+def write_data_to_file(data: Any,
+                       operation: str | None,
+                       directory: str = '.') -> str:
+    file_path = report_file_path(operation, directory)
+    with open(file_path, mode='w') as file:
+        json.dump(data, file)
+    return file_path
+
+
+async def save_data_to_file(data: Any,
+                            operation: str | None) -> None:
+    write_data_to_file(data, operation)
+
+
+def build_processed_table(raw_table: list,
+                          operation: str | None,
+                          scale: int = money_scale) -> tuple[dict, list]:
+    """
+    Return the report data, which is written to the JSON file,
+    and the table for printing.
+    """
+    if operation == Operation.approximate_stats.value:
+        return approximate_stats_report(build_department_sketches(raw_table),
+                                        scale)
     headers = raw_table[0]
     if operation is None:
-        pass
+        operation_dict = raw_data_table_to_dict(raw_table.copy(),
+                                                scale=scale)
+        raw_table.pop(0)
+        return operation_dict, [headers, *(
+            [*row[:5], format_money(row[5], scale)] for row in raw_table
+        )]
+    aggregator = StaffAggregator(scale=scale)
+    department_rows = {}
+    for row in range(1, len(raw_table)):
+        aggregator.append(raw_table[row])
+        department_rows.setdefault(raw_table[row][2], []).append(
+            raw_table[row]
+        )
+    oper_dep_dict_list = list(iter_department_reports(aggregator, operation))
+    operation_dict = {operation: oper_dep_dict_list}
     if operation == Operation.payout.value:
         headers.append(operation)
     if operation == Operation.average_rate.value:
         headers = [*headers, 'payout', operation]
     processed_table = [headers]
-    if operation is None:
-        raw_table.pop(0)
-        for row in raw_table:
-            processed_table.append(row)
-    else:
-        for i in range(len(oper_dep_dict_list)):
-            department = oper_dep_dict_list[i]['department']
-            depart_line = 0
-            while raw_table[depart_line][2] != department:
-                depart_line += 1
+    for department_dict in oper_dep_dict_list:
+        department = department_dict['department']
+        for line, row in enumerate(department_rows[department]):
+            if line:
+                row[2] = '-' * len(department)
             # Блоки кода с условиями сделаны таким образом,
             # Чтобы можно было добавить новое условие для нового типа отчета
             # Где могут быть произведены другие расчеты между столбцами
             if operation == Operation.payout.value:
-                hours = 0
-                payout = 0
-                hours += raw_table[depart_line][4]
-                payout_first = \
-                    raw_table[depart_line][4] * raw_table[depart_line][5]
-                payout += payout_first
-                for s in range(len(oper_dep_dict_list[i]['staff'])):
-                    if oper_dep_dict_list[i]['staff'][s]['email'] \
-                            == raw_table[depart_line][1]:
-                        oper_dep_dict_list[i]['staff'][s]. \
-                            update({'payout': payout_first})
-                first_depart_line = [
-                    *raw_table[depart_line], payout_first
-                ]
-            if operation == Operation.average_rate.value:
-                hours = 0
-                payout = 0
-                hours += raw_table[depart_line][4]
-                payout_first = \
-                    raw_table[depart_line][4] * raw_table[depart_line][5]
-                payout += payout_first
-                for s in range(len(oper_dep_dict_list[i]['staff'])):
-                    if oper_dep_dict_list[i]['staff'][s]['email'] \
-                            == raw_table[depart_line][1]:
-                        oper_dep_dict_list[i]['staff'][s]. \
-                            update({'payout': payout_first})
-                first_depart_line = [*raw_table[depart_line], payout_first, '']
-            processed_table.append(first_depart_line)
-            raw_table.pop(depart_line)
-            for row in range(len(raw_table)):
-                if raw_table[row][2] == department:
-                    raw_table[row][2] = '-' * len(department)
-                    if operation == Operation.payout.value:
-                        hours += raw_table[row][4]
-                        payout_other = raw_table[row][4] * raw_table[row][5]
-                        payout += payout_other
-                        for s in range(
-                                len(operation_dict[operation][i]['staff'])
-                        ):
-                            if oper_dep_dict_list[i]['staff'][s]['email']\
-                                    == raw_table[row][1]:
-                                oper_dep_dict_list[i]['staff'][s].\
-                                    update({'payout': payout_other})
-                        other_depart_line = [*raw_table[row], payout_other]
-                    if operation == Operation.average_rate.value:
-                        hours += raw_table[row][4]
-                        payout_other = raw_table[row][4] * raw_table[row][5]
-                        payout += payout_other
-                        for s in range(
-                                len(operation_dict[operation][i]['staff'])
-                        ):
-                            if oper_dep_dict_list[i]['staff'][s]['email'] \
-                                    == raw_table[row][1]:
-                                oper_dep_dict_list[i]['staff'][s]. \
-                                    update({'payout': payout_other})
-                        other_depart_line = [*raw_table[row], payout_other, '']
-                    processed_table.append(other_depart_line)
-            if operation == Operation.payout.value:
-                total_line = ['', '', '', '', hours, '', payout]
-            if operation == Operation.average_rate.value:
-                average_rate = round((payout / hours), 2)
-                total_line = ['', '', '', '', hours, '', payout, average_rate]
-            processed_table.append(total_line)
-            if operation == Operation.payout.value:
-                operation_dict[operation][i].update({'hours': hours})
-                operation_dict[operation][i].update({'payout': payout})
+                processed_table.append([*row[:5],
+                                        format_money(row[5], scale),
+                                        format_money(row[4] * row[5],
+                                                     scale)])
             if operation == Operation.average_rate.value:
-                operation_dict[operation][i].update({'hours': hours})
-                operation_dict[operation][i].update({'payout': payout})
-                operation_dict[operation][i].\
-                    update({'average_rate': average_rate})
+                processed_table.append([*row[:5],
+                                        format_money(row[5], scale),
+                                        format_money(row[4] * row[5],
+                                                     scale),
+                                        ''])
+        if operation == Operation.payout.value:
+            total_line = ['', '', '', '', department_dict['hours'], '',
+                          department_dict['payout']]
+        if operation == Operation.average_rate.value:
+            total_line = ['', '', '', '', department_dict['hours'], '',
+                          department_dict['payout'],
+                          department_dict['average_rate']]
+        processed_table.append(total_line)
+    return operation_dict, processed_table
+
+
+async def process_raw_table_to_processed_table(
+        raw_table: list,
+        operation: str | None,
+        scale: int = money_scale
+) -> list:
+    operation_dict, processed_table = build_processed_table(raw_table,
+                                                            operation,
+                                                            scale)
     await save_data_to_file(operation_dict, operation)
     return processed_table
 
@@ -442,6 +1289,497 @@ def print_table(table):
         )
 
 
+pivot_values = ['payout', 'hours', 'rate']
+
+
+class PivotAggregator:
+    """
+    Hash aggregation of hours, payout and average rate by any
+    combination of canonical columns. With top set, hours and payout
+    are also summed per employee (by email) inside every group, and the
+    top employees by payout, hours or average rate are chosen with
+    a bounded heap, without sorting the whole group. Rows are passed
+    to append like to raw_table, with rates in 10 ** -scale units.
+    """
+
+    def __init__(self, group_by: list[str],
+                 top: int | None = None,
+                 by: str = 'payout',
+                 scale: int = money_scale):
+        self.group_by = group_by
+        self.scale = scale
+        self.key_indexes = [canonical_header.index(column)
+                            for column in group_by]
+        self.top = top
+        self.by = by
+        self.groups = {}
+        self.sequence = 0
+
+    def append(self, row: list) -> None:
+        key = tuple(row[index] for index in self.key_indexes)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = [0, 0, {}]
+        payout = row[4] * row[5]
+        group[0] += row[4]
+        group[1] += payout
+        if self.top:
+            employee = group[2].get(row[1])
+            if employee is None:
+                group[2][row[1]] = [self.sequence, row[0], row[3],
+                                    row[4], payout]
+            else:
+                employee[3] += row[4]
+                employee[4] += payout
+        self.sequence += 1
+
+    def top_employees(self, employees: dict) -> list:
+        def rank(employee: tuple) -> tuple:
+            _, sequence, _, _, hours, payout = employee
+            if self.by == 'payout':
+                value = payout
+            elif self.by == 'hours':
+                value = hours
+            else:
+                value = divide_money(payout, hours)
+            # При равенстве значений выше стоит сотрудник, встреченный раньше
+            return value, -sequence
+
+        return heapq.nlargest(
+            self.top,
+            ((email, *employee) for email, employee in employees.items()),
+            key=rank
+        )
+
+    def to_dict_list(self) -> list:
+        group_dict_list = []
+        for key, (hours, payout, employees) in self.groups.items():
+            group_dict = dict(zip(self.group_by, key))
+            if 'rate' in group_dict:
+                group_dict['rate'] = format_money(group_dict['rate'],
+                                                  self.scale)
+            # Сумма часов хранится под своим именем, чтобы не затереть
+            # значение столбца hours, если группировка идёт по нему
+            group_dict.update(
+                total_hours=hours,
+                payout=format_money(payout, self.scale),
+                average_rate=format_money(divide_money(payout, hours),
+                                          self.scale)
+            )
+            if self.top:
+                group_dict['top'] = [
+                    dict(id=id_point,
+                         email=email,
+                         name=name,
+                         hours=employee_hours,
+                         rate=format_money(divide_money(employee_payout,
+                                                        employee_hours),
+                                           self.scale),
+                         payout=format_money(employee_payout, self.scale))
+                    for email, _, id_point, name, employee_hours,
+                    employee_payout in self.top_employees(employees)
+                ]
+            group_dict_list.append(group_dict)
+        return group_dict_list
+
+
+def parse_group_by(group_by: str | list[str]) -> list[str]:
+    if isinstance(group_by, str):
+        group_by = group_by.split(',')
+    columns = []
+    # Пустой список отклоняется так же, как неизвестный столбец
+    for column in [*group_by] or ['']:
+        canonical_column = header_aliases.get(column.strip())
+        if canonical_column is None or canonical_column in columns:
+            raise ReportError(f'Group by one or more different columns '
+                              f'from: {", ".join(canonical_header)}')
+        columns.append(canonical_column)
+    return columns
+
+
+def pivot_table(group_dict_list: list,
+                group_by: list[str],
+                top: int | None = None,
+                by: str = 'payout') -> list:
+    group_columns = [*group_by, 'total_hours', 'payout', 'average_rate']
+    headers = [*group_columns, 'top', 'email', 'name', by] \
+        if top else group_columns
+    processed_table = [headers]
+    for group_dict in group_dict_list:
+        group_line = [group_dict[column] for column in group_columns]
+        if not top:
+            processed_table.append(group_line)
+            continue
+        if not group_dict['top']:
+            processed_table.append([*group_line, '', '', '', ''])
+        for place, row in enumerate(group_dict['top'], start=1):
+            processed_table.append([
+                *(group_line if place == 1 else [''] * len(group_line)),
+                place, row['email'], row['name'], row[by]
+            ])
+    return processed_table
+
+
+diff_columns = ['record', 'change', 'department', 'email', 'name', 'rate',
+                'old_rate', 'hours', 'hours_delta', 'payout', 'payout_delta']
+
+
+def add_to_staff_index(staff_index: dict,
+                       department: str,
+                       staff: dict) -> None:
+    key = (department, staff['email'], staff['rate'])
+    indexed_staff = staff_index.get(key)
+    if indexed_staff is None:
+        staff_index[key] = dict(name=staff['name'],
+                                hours=staff['hours'],
+                                payout=staff['payout'])
+    else:
+        indexed_staff['hours'] += staff['hours']
+        indexed_staff['payout'] += staff['payout']
+
+
+def report_money(value: float, scale: int = money_scale) -> int:
+    return parse_money(repr(value), scale)
+
+
+def load_staff_index(data_files: list[str],
+                     scale: int = money_scale) -> tuple[dict, dict] | None:
+    """
+    Load one payout or average-rate JSON report, or a set of CSV files,
+    into staff index by (department, email, rate)
+    and department index by department.
+    """
+    staff_index = {}
+    department_index = {}
+    if len(data_files) == 1 and data_files[0].endswith('.json'):
+        report_path = os.path.abspath(data_files[0])
+        try:
+            with open(data_files[0], mode='r') as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return print(f"{report_path} not found.")
+        except json.JSONDecodeError:
+            return print(f'{report_path} is not a valid JSON report')
+        operation = next(iter(data), None) if isinstance(data, dict) \
+            else None
+        if operation not in (Operation.payout.value,
+                             Operation.average_rate.value):
+            return print(f'{report_path} should be '
+                         f'payout or average-rate report')
+        try:
+            for department in data[operation]:
+                for staff in department['staff']:
+                    add_to_staff_index(
+                        staff_index,
+                        department['department'],
+                        dict(staff,
+                             rate=report_money(staff['rate'], scale),
+                             payout=report_money(staff['payout'], scale))
+                    )
+                department_index[department['department']] = dict(
+                    hours=department['hours'],
+                    payout=report_money(department['payout'], scale)
+                )
+        except (KeyError, TypeError, ArithmeticError, ValueError):
+            return print(f'{report_path} is not a complete '
+                         f'{operation} report')
+        return staff_index, department_index
+    if not all(data_file.endswith('.csv') for data_file in data_files):
+        return print('Compare one JSON report or a set of csv files')
+    aggregator = StaffAggregator(scale=scale)
+    for data_file in data_files:
+        read_data_from_path(data_file, aggregator, scale)
+    for department, staff in aggregator.iter_staff():
+        staff['payout'] = staff['hours'] * staff['rate']
+        add_to_staff_index(staff_index, department, staff)
+    for department in aggregator.departments:
+        department_index[department] = aggregator.department_totals(
+            department, Operation.payout.value
+        )
+    return staff_index, department_index
+
+
+def staff_delta(change: str,
+                key: tuple,
+                old_staff: dict | None,
+                new_staff: dict | None,
+                old_rate: int | None = None,
+                scale: int = money_scale) -> dict:
+    staff = new_staff if new_staff is not None else old_staff
+    if old_rate is not None:
+        old_rate = format_money(old_rate, scale)
+    old_hours = old_staff['hours'] if old_staff is not None else 0
+    old_payout = old_staff['payout'] if old_staff is not None else 0
+    hours = new_staff['hours'] if new_staff is not None else 0
+    payout = new_staff['payout'] if new_staff is not None else 0
+    return dict(record='staff',
+                change=change,
+                department=key[0],
+                email=key[1],
+                name=staff['name'],
+                rate=format_money(key[2], scale),
+                old_rate=old_rate if old_rate is not None else '',
+                hours=hours,
+                hours_delta=hours - old_hours,
+                payout=format_money(payout, scale),
+                payout_delta=format_money(payout - old_payout, scale))
+
+
+def iter_staff_diff(old_index: dict, new_index: dict,
+                    scale: int = money_scale) -> Iterable:
+    """
+    Yield staff changes in linear time. Removed and added records
+    of the same department and email are paired into rate_changed.
+    """
+    added = []
+    for key, new_staff in new_index.items():
+        old_staff = old_index.get(key)
+        if old_staff is None:
+            added.append(key)
+        elif old_staff['hours'] != new_staff['hours'] \
+                or old_staff['payout'] != new_staff['payout']:
+            yield staff_delta('changed', key, old_staff, new_staff,
+                              scale=scale)
+    removed = {}
+    for key in old_index:
+        if key not in new_index:
+            removed.setdefault(key[:2], []).append(key)
+    for key in added:
+        removed_keys = removed.get(key[:2])
+        if removed_keys:
+            old_key = removed_keys.pop(0)
+            yield staff_delta('rate_changed', key, old_index[old_key],
+                              new_index[key], old_key[2], scale)
+        else:
+            yield staff_delta('added', key, None, new_index[key],
+                              scale=scale)
+    for removed_keys in removed.values():
+        for key in removed_keys:
+            yield staff_delta('removed', key, old_index[key], None,
+                              scale=scale)
+
+
+def iter_department_diff(old_departments: dict,
+                         new_departments: dict,
+                         scale: int = money_scale) -> Iterable:
+    empty_department = dict(hours=0, payout=0)
+    for department in {**old_departments, **new_departments}:
+        old_department = old_departments.get(department, empty_department)
+        new_department = new_departments.get(department, empty_department)
+        hours_delta = new_department['hours'] - old_department['hours']
+        payout_delta = new_department['payout'] - old_department['payout']
+        if department not in old_departments:
+            change = 'added'
+        elif department not in new_departments:
+            change = 'removed'
+        elif hours_delta or payout_delta:
+            change = 'changed'
+        else:
+            continue
+        yield dict(record='department',
+                   change=change,
+                   department=department,
+                   email='',
+                   name='',
+                   rate='',
+                   old_rate='',
+                   hours=new_department['hours'],
+                   hours_delta=hours_delta,
+                   payout=format_money(new_department['payout'], scale),
+                   payout_delta=format_money(payout_delta, scale))
+
+
+def write_diff_to_file(deltas: Iterable,
+                       diff_format: str = 'json',
+                       directory: str = '.') -> str:
+    """
+    Write delta records to diff_{today}.jsonl (one compact JSON record
+    per line) or diff_{today}.csv, one record at a time.
+    """
+    file_path = report_file_path('diff', directory,
+                                 'csv' if diff_format == 'csv' else 'jsonl')
+    with open(file_path, mode='w', newline='') as file:
+        if diff_format == 'csv':
+            writer = csv.DictWriter(file, fieldnames=diff_columns)
+            writer.writeheader()
+            writer.writerows(deltas)
+        else:
+            for delta in deltas:
+                file.write(json.dumps(delta, separators=(',', ':')) + '\n')
+    return file_path
+
+
+def build_diff(old_sources: list[str],
+               new_sources: list[str],
+               scale: int = money_scale) -> Iterable | None:
+    """
+    Load both sides and return the iterator of staff and then department
+    delta records.
+    """
+    old_indexes = load_staff_index(old_sources, scale)
+    if old_indexes is None:
+        return
+    new_indexes = load_staff_index(new_sources, scale)
+    if new_indexes is None:
+        return
+    return itertools.chain(
+        iter_staff_diff(old_indexes[0], new_indexes[0], scale),
+        iter_department_diff(old_indexes[1], new_indexes[1], scale)
+    )
+
+
+def count_diff(deltas: Iterable, counts: dict) -> Iterable:
+    for delta in deltas:
+        key = (delta['record'], delta['change'])
+        counts[key] = counts.get(key, 0) + 1
+        yield delta
+
+
+@dataclass
+class StaffRecord:
+    id: int
+    email: str
+    department: str
+    name: str
+    hours: int
+    rate: float
+    payout: float | None = None
+
+
+@dataclass
+class DepartmentRecord:
+    department: str
+    hours: int
+    payout: float
+    average_rate: float | None = None
+    staff: list[StaffRecord] = field(default_factory=list)
+
+
+@dataclass
+class Report:
+    """
+    Report data, as written to the JSON file, and the table for
+    printing. Payout and average-rate reports are also given as
+    department records, the raw report as staff records.
+    """
+    operation: str | None
+    data: dict
+    table: list
+    file_path: str | None = None
+
+    @property
+    def departments(self) -> list[DepartmentRecord]:
+        if self.operation not in (Operation.payout.value,
+                                  Operation.average_rate.value):
+            return []
+        return [
+            DepartmentRecord(
+                department=department['department'],
+                hours=department['hours'],
+                payout=department['payout'],
+                average_rate=department.get('average_rate'),
+                staff=[StaffRecord(department=department['department'],
+                                   **staff)
+                       for staff in department['staff']]
+            )
+            for department in self.data[self.operation]
+        ]
+
+    @property
+    def staff(self) -> list[StaffRecord]:
+        if self.operation is None:
+            return [StaffRecord(**staff) for staff in self.data['raw_table']]
+        return [staff for department in self.departments
+                for staff in department.staff]
+
+
+class ReportEngine:
+    """
+    Synchronous API for building reports inside a Python process.
+    Every source is a path to a CSV file, an opened text file or
+    an iterable of rows split into columns, where the first row is
+    the header. Header plans and validators are shared between calls.
+    Nothing is written or printed unless save_to_file or print_output
+    is set. Money is kept in units of 10 ** -money_scale, the scale is
+    passed to every call, so engines with different scales can run in
+    parallel threads. Invalid data and arguments raise ReportError with
+    the message printed by the script.
+    """
+
+    def __init__(self,
+                 save_to_file: bool = False,
+                 print_output: bool = False,
+                 output_dir: str = '.',
+                 money_scale: int = money_scale):
+        if money_scale < 0:
+            raise ReportError('Money scale should not be negative')
+        self.save_to_file = save_to_file
+        self.print_output = print_output
+        self.output_dir = output_dir
+        self.money_scale = money_scale
+
+    def read(self, *sources: Any) -> list:
+        return self._read_into([list(canonical_header)], sources)
+
+    def _read_into(self, raw_table: Any, sources: tuple) -> Any:
+        for source in sources:
+            if isinstance(source, (str, os.PathLike)):
+                read_data_from_path(source, raw_table, self.money_scale)
+            elif hasattr(source, 'readline'):
+                read_data_from_lines(source,
+                                     getattr(source, 'name', '<file>'),
+                                     raw_table,
+                                     self.money_scale)
+            else:
+                read_data_from_rows(
+                    ([str(value) for value in row] for row in source),
+                    '<rows>',
+                    raw_table,
+                    self.money_scale
+                )
+        return raw_table
+
+    def run(self, *sources: Any, operation: str | None = None) -> Report:
+        if operation is not None and operation not in operation_list:
+            raise ReportError(f'Unknown report {operation}. '
+                              f'Choose from {", ".join(operation_list)}')
+        if operation == Operation.approximate_stats.value:
+            sketches = self._read_into(DepartmentSketchAggregator(), sources)
+            data, table = approximate_stats_report(sketches.departments,
+                                                   self.money_scale)
+        else:
+            raw_table = self.read(*sources)
+            data, table = build_processed_table(raw_table, operation,
+                                                self.money_scale)
+        file_path = None
+        if self.save_to_file:
+            file_path = write_data_to_file(data, operation, self.output_dir)
+        if self.print_output:
+            print_table([list(row) for row in table])
+        return Report(operation, data, table, file_path)
+
+    def pivot(self, *sources: Any,
+              group_by: list[str],
+              top: int | None = None,
+              by: str = 'payout') -> Report:
+        group_by = parse_group_by(group_by)
+        if top is not None and top <= 0:
+            raise ReportError('top should be positive integer')
+        if by not in pivot_values:
+            raise ReportError(f'Top by {", ".join(pivot_values)}')
+        pivot = self._read_into(
+            PivotAggregator(group_by, top, by, self.money_scale), sources
+        )
+        data = {'pivot': pivot.to_dict_list()}
+        table = pivot_table(data['pivot'], group_by, top, by)
+        file_path = None
+        if self.save_to_file:
+            file_path = write_data_to_file(data, 'pivot', self.output_dir)
+        if self.print_output:
+            print_table([list(row) for row in table])
+        return Report('pivot', data, table, file_path)
+
+
 async def main():
     parser = argparse.ArgumentParser(
         description="Display and process all CSV-Data files,"
@@ -457,22 +1795,152 @@ async def main():
                         choices=[report for report in operation_list],
                         help='Choose report name you want to process. '
                              'For example, "payout"')
+    parser.add_argument('--max-memory', type=int,
+                        default=None,
+                        help='Memory budget in megabytes for grouping staff '
+                             'in payout and average-rate reports. '
+                             'Groups over the budget are spilled to '
+                             'temporary files, and only department totals '
+                             'are displayed')
+    parser.add_argument('--diff', type=str,
+                        nargs='+',
+                        default=None,
+                        help='Previous payout or average-rate JSON report '
+                             'or csv-files to compare with the given '
+                             'files. Example: "payout_2024_01_01.json"')
+    parser.add_argument('--diff-format', type=str,
+                        default='json',
+                        choices=['json', 'csv'],
+                        help='Format of the diff file')
+    parser.add_argument('--group-by', type=str,
+                        default=None,
+                        help='Comma separated columns to group hours, '
+                             'payout and average rate by. '
+                             'For example, "department,name"')
+    parser.add_argument('--top', type=int,
+                        default=None,
+                        help='Show top N rows of every group '
+                             '(by department, if --group-by is not set)')
+    parser.add_argument('--by', type=str,
+                        default='payout',
+                        choices=pivot_values,
+                        help='Column for choosing top rows')
+    parser.add_argument('--checkpoint-dir', type=str,
+                        default=None,
+                        help='Directory for checkpoints of payout and '
+                             'average-rate reports')
+    parser.add_argument('--checkpoint-every', type=int,
+                        default=checkpoint_rows,
+                        help='Number of rows between checkpoints')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue the job from the last checkpoint '
+                             'in --checkpoint-dir')
+    parser.add_argument('--money-scale', type=int,
+                        default=money_scale,
+                        help='Number of decimal digits kept in rates and '
+                             f'payouts. Default is {money_scale}')
     args = parser.parse_args()
+    if args.money_scale < 0:
+        return print('--money-scale should not be negative')
+    try:
+        return await run_command(args)
+    except ReportError as error:
+        return print(error)
+
+
+async def run_command(args: argparse.Namespace) -> None:
     data_files = []
     raw_data = args.csv_files
     for data in raw_data:
-        if data.endswith('.csv'):
+        if data.endswith('.csv') \
+                or (args.diff is not None and data.endswith('.json')):
             data_files.append(data)
         else:
             return print('Valid only csv files to process')
+    if args.diff is not None:
+        deltas = build_diff(args.diff, data_files, args.money_scale)
+        if deltas is None:
+            return
+        counts = {}
+        file_path = write_diff_to_file(count_diff(deltas, counts),
+                                       args.diff_format)
+        print(f'Diff is written to {os.path.abspath(file_path)}')
+        return print_table([
+            ['record', 'change', 'count'],
+            *([*key, count] for key, count in counts.items())
+        ])
     operation = args.report
     if not args.report:
         operation = None
-    table = await read_data_from_data_files(data_files)
+    if args.group_by is not None or args.top is not None:
+        if operation is not None or args.max_memory is not None \
+                or args.checkpoint_dir is not None:
+            return print('--group-by and --top can not be used with '
+                         '--report, --max-memory and --checkpoint-dir')
+        group_by = parse_group_by(args.group_by or 'department')
+        if args.top is not None and args.top <= 0:
+            return print('--top should be positive integer')
+        pivot = PivotAggregator(group_by, args.top, args.by,
+                                args.money_scale)
+        for data_file in data_files:
+            read_data_from_path(data_file, pivot, args.money_scale)
+        data = {'pivot': pivot.to_dict_list()}
+        await save_data_to_file(data, 'pivot')
+        return print_table(pivot_table(data['pivot'], group_by,
+                                       args.top, args.by))
+    if operation == Operation.approximate_stats.value:
+        sketches = DepartmentSketchAggregator()
+        for data_file in data_files:
+            read_data_from_path(data_file, sketches, args.money_scale)
+        data, table = approximate_stats_report(sketches.departments,
+                                               args.money_scale)
+        await save_data_to_file(data, operation)
+        return print_table(table)
+    if args.resume and args.checkpoint_dir is None:
+        return print('--resume needs --checkpoint-dir')
+    if args.checkpoint_every <= 0:
+        return print('--checkpoint-every should be positive integer')
+    if args.max_memory is not None or args.checkpoint_dir is not None:
+        if operation not in (Operation.payout.value,
+                             Operation.average_rate.value):
+            return print('--max-memory and --checkpoint-dir work only '
+                         'with payout and average-rate reports')
+        max_memory = None
+        if args.max_memory is not None:
+            max_memory = args.max_memory * 1024 * 1024
+        if args.checkpoint_dir is None:
+            aggregator = StaffAggregator(max_memory=max_memory,
+                                         scale=args.money_scale)
+            try:
+                for data_file in data_files:
+                    read_data_from_path(data_file, aggregator,
+                                        args.money_scale)
+            except ReportError:
+                aggregator.close()
+                raise
+        else:
+            aggregator = aggregate_with_checkpoints(data_files,
+                                                    operation,
+                                                    args.checkpoint_dir,
+                                                    args.resume,
+                                                    args.checkpoint_every,
+                                                    max_memory,
+                                                    args.money_scale)
+            if aggregator is None:
+                return
+        try:
+            write_aggregated_report(aggregator, operation)
+            table = aggregated_report_table(aggregator, operation)
+        finally:
+            aggregator.close()
+        if args.checkpoint_dir is not None:
+            clear_checkpoint(args.checkpoint_dir)
+        return print_table(table)
+    table = await read_data_from_data_files(data_files, args.money_scale)
     if table is None:
         return
     proc_table = await process_raw_table_to_processed_table(
-        table, operation
+        table, operation, args.money_scale
     )
     print_table(proc_table)
 
@@ -1,16 +1,42 @@
 import asyncio
 import json
+import os
 from datetime import datetime, timezone
 import pytest
 
 from unittest.mock import patch
+from concurrent.futures import ThreadPoolExecutor
+
+import main as main_module
 
 from main import (
     read_data_from_data_files,
     check_unique_element_in_process_list,
     process_raw_data_table_to_dict,
     process_raw_table_to_processed_table,
-    print_table
+    print_table,
+    HyperLogLog,
+    KLLSketch,
+    build_department_sketches,
+    merge_department_sketches,
+    load_department_sketches,
+    ReportEngine,
+    ReportError,
+    StaffRecord,
+    DepartmentRecord,
+    StaffAggregator,
+    write_aggregated_report,
+    build_diff,
+    write_diff_to_file,
+    parse_money,
+    format_money,
+    divide_money,
+    PivotAggregator,
+    parse_group_by,
+    pivot_table,
+    aggregate_with_checkpoints,
+    read_checkpoint,
+    main
                   )
 
 
@@ -44,9 +70,9 @@ def test_read_data_from_data_files():
     )
     assert raw_table == [
         ['id', 'email', 'department', 'name', 'hours', 'rate'],
-        [101, 'grace@example.com', 'HR', 'Grace Lee', 160, 45],
-        [102, 'bob@example.com', 'Marketing', 'Bob Dylan', 240, 32],
-        [103, 'john@example.com', 'Marketing', 'John Dylan', 190, 45]
+        [101, 'grace@example.com', 'HR', 'Grace Lee', 160, 4500],
+        [102, 'bob@example.com', 'Marketing', 'Bob Dylan', 240, 3200],
+        [103, 'john@example.com', 'Marketing', 'John Dylan', 190, 4500]
     ]
 
 
@@ -325,3 +351,514 @@ async def test_print_operated_table(capsys):
                             "|     |                   "
                             "|            |            | 430   |      "
                             "| 16230.0 |\n")
+
+
+def test_hyperloglog_count_and_merge():
+    first_sketch = HyperLogLog()
+    second_sketch = HyperLogLog()
+    for number in range(6000):
+        first_sketch.add(f'staff{number}@example.com')
+    for number in range(4000, 10000):
+        second_sketch.add(f'staff{number}@example.com')
+    first_sketch.merge(second_sketch)
+    assert abs(first_sketch.count() - 10000) < 10000 * 0.05
+    restored_sketch = HyperLogLog.from_dict(first_sketch.to_dict())
+    assert restored_sketch.count() == first_sketch.count()
+
+
+def test_kll_sketch_quantiles_and_merge():
+    small_sketch = KLLSketch()
+    for rate in [45, 32, 45, 50, 10]:
+        small_sketch.add(rate)
+    assert small_sketch.quantile(0.5) == 45
+    first_sketch = KLLSketch()
+    second_sketch = KLLSketch(seed=1)
+    for rate in range(1, 50001):
+        first_sketch.add(rate)
+        second_sketch.add(rate + 50000)
+    first_sketch.merge(second_sketch)
+    assert first_sketch.size < 3 * first_sketch.k
+    assert abs(first_sketch.quantile(0.5) - 50000) < 100000 * 0.02
+    assert abs(first_sketch.quantile(0.9) - 90000) < 100000 * 0.02
+
+
+@pytest.mark.asyncio
+async def test_approximate_stats_report():
+    raw_table = await read_data_from_data_files(
+        ['csv-script/tests/example.csv']
+    )
+    processed_table = await process_raw_table_to_processed_table(
+        raw_table, 'approximate-stats'
+    )
+    assert processed_table == [
+        ['department', 'distinct_staff', 'rate_median', 'rate_p90'],
+        ['HR', 1, 45.0, 45.0],
+        ['Marketing', 2, 32.0, 45.0]
+    ]
+    create_date = datetime.now(timezone.utc).strftime(date_time_format)
+    read_data = read_json_file(f'approximate-stats_{create_date}.json')
+    department_sketches = merge_department_sketches(
+        load_department_sketches(read_data),
+        build_department_sketches(raw_table)
+    )
+    assert department_sketches['Marketing'].staff.count() == 2
+    assert department_sketches['Marketing'].rates.quantile(0.5) == 3200
+
+
+def test_report_engine_sources():
+    engine = ReportEngine()
+    path_report = engine.run('csv-script/tests/example.csv',
+                             operation='payout')
+    assert path_report.file_path is None
+    assert path_report.table[-1] == ['', '', '', '', 430, '', 16230.0]
+    with open('csv-script/tests/example.csv', mode='r') as file:
+        file_report = engine.run(file, operation='payout')
+    rows_report = engine.run(
+        [['department', 'id', 'email', 'name', 'hours_worked', 'rate'],
+         ['HR', 101, 'grace@example.com', 'Grace Lee', 160, 45],
+         ['Marketing', 102, 'bob@example.com', 'Bob Dylan', 240, 32],
+         ['Marketing', 103, 'john@example.com', 'John Dylan', 190, 45]],
+        operation='payout'
+    )
+    assert file_report.data == path_report.data
+    assert rows_report.table == path_report.table
+    with pytest.raises(ReportError, match='Id column row 2'):
+        engine.run('csv-script/tests/wrong_id.csv')
+    with pytest.raises(ReportError, match='not found'):
+        engine.run('csv-script/tests/no_way.csv')
+
+
+def test_report_engine_records():
+    report = ReportEngine().run('csv-script/tests/example.csv',
+                                operation='average-rate')
+    assert report.departments[1] == DepartmentRecord(
+        department='Marketing', hours=430, payout=16230.0,
+        average_rate=37.74,
+        staff=[StaffRecord(102, 'bob@example.com', 'Marketing',
+                           'Bob Dylan', 240, 32.0, 7680.0),
+               StaffRecord(103, 'john@example.com', 'Marketing',
+                           'John Dylan', 190, 45.0, 8550.0)]
+    )
+    assert len(report.staff) == 3
+    raw_report = ReportEngine().run('csv-script/tests/example.csv')
+    assert raw_report.staff[0] == StaffRecord(
+        101, 'grace@example.com', 'HR', 'Grace Lee', 160, 45.0
+    )
+    assert raw_report.departments == []
+
+
+def test_report_engine_output(tmp_path, capsys):
+    engine = ReportEngine(save_to_file=True,
+                          print_output=True,
+                          output_dir=str(tmp_path))
+    report = engine.run('csv-script/tests/example.csv',
+                        operation='average-rate')
+    assert read_json_file(report.file_path) == report.data
+    assert report.data['average-rate'][1]['average_rate'] == 37.74
+    assert capsys.readouterr().out.startswith('| id  | email ')
+    with pytest.raises(ValueError):
+        engine.run('csv-script/tests/example.csv', operation='foo')
+
+
+def staff_rows():
+    rows = [['department', 'id', 'email', 'name', 'hours_worked', 'rate']]
+    for number in range(600):
+        staff_number = number * 7 % 150
+        rows.append([f'Department{number % 5}',
+                     staff_number,
+                     f'staff{staff_number}@example.com',
+                     'Staff Name',
+                     number % 40,
+                     [12.5, 30, 41.25][number % 3]])
+    return rows
+
+
+def test_spilled_aggregation_equals_in_memory(tmp_path):
+    report = ReportEngine(save_to_file=True, output_dir=str(tmp_path)).run(
+        staff_rows(), operation='average-rate'
+    )
+    with open(report.file_path, mode='r') as file:
+        in_memory_report = file.read()
+    os.remove(report.file_path)
+    aggregator = StaffAggregator(max_memory=4000, partitions=2)
+    for row in ReportEngine().read(staff_rows())[1:]:
+        aggregator.append(row)
+    assert aggregator.spill_files
+    file_path = write_aggregated_report(aggregator, 'average-rate',
+                                        str(tmp_path))
+    # Части больше бюджета разбиваются на подчасти
+    assert len(aggregator.run_files) > 2 * aggregator.partitions
+    aggregator.close()
+    with open(file_path, mode='r') as file:
+        assert file.read() == in_memory_report
+
+
+def test_spilled_runs_merged_in_bounded_passes(tmp_path, monkeypatch):
+    report = ReportEngine(save_to_file=True, output_dir=str(tmp_path)).run(
+        staff_rows(), operation='payout'
+    )
+    with open(report.file_path, mode='r') as file:
+        in_memory_report = file.read()
+    os.remove(report.file_path)
+    monkeypatch.setattr(main_module, 'max_open_runs', 3)
+    aggregator = StaffAggregator(max_memory=2000, partitions=2)
+    for row in ReportEngine().read(staff_rows())[1:]:
+        aggregator.append(row)
+    file_path = write_aggregated_report(aggregator, 'payout', str(tmp_path))
+    assert len(aggregator.run_files) > main_module.max_open_runs ** 2
+    spill_dir = aggregator.spill_dir
+    # После слияния остаются только файлы последнего прохода
+    assert len([name for name in os.listdir(spill_dir)
+                if 'run' in name or name.startswith('merge')]) <= 3
+    aggregator.close()
+    with open(file_path, mode='r') as file:
+        assert file.read() == in_memory_report
+
+
+def test_main_with_max_memory(tmp_path, monkeypatch, capsys):
+    data_file = os.path.abspath('csv-script/tests/example.csv')
+    monkeypatch.chdir(tmp_path)
+    with patch('sys.argv', ['main.py', data_file, '--report', 'payout',
+                            '--max-memory', '1']):
+        asyncio.run(main())
+    assert capsys.readouterr().out == ("| department | hours | payout  |\n"
+                                       "| HR         | 160   | 7200.0  |\n"
+                                       "| Marketing  | 430   | 16230.0 |\n")
+    create_date = datetime.now(timezone.utc).strftime(date_time_format)
+    read_data = read_json_file(f'payout_{create_date}.json')
+    assert read_data['payout'][1]['staff'][1]['payout'] == 8550
+
+
+def test_build_diff_between_csv_files():
+    deltas = list(build_diff(['csv-script/tests/example.csv'],
+                             ['csv-script/tests/example_changed.csv']))
+    assert [(delta['record'], delta['change'], delta['department'],
+             delta['email']) for delta in deltas] == [
+        ('staff', 'changed', 'HR', 'grace@example.com'),
+        ('staff', 'rate_changed', 'Marketing', 'bob@example.com'),
+        ('staff', 'added', 'Sales', 'ann@example.com'),
+        ('staff', 'removed', 'Marketing', 'john@example.com'),
+        ('department', 'changed', 'HR', ''),
+        ('department', 'changed', 'Marketing', ''),
+        ('department', 'added', 'Sales', '')
+    ]
+    assert deltas[1]['old_rate'] == 32.0
+    assert deltas[1]['payout_delta'] == 720.0
+    assert deltas[5]['hours_delta'] == -190
+
+
+@pytest.mark.asyncio
+async def test_build_diff_with_json_report(tmp_path):
+    raw_table = await read_data_from_data_files(
+        ['csv-script/tests/example.csv']
+    )
+    await process_raw_table_to_processed_table(raw_table, 'payout')
+    create_date = datetime.now(timezone.utc).strftime(date_time_format)
+    assert list(build_diff([f'payout_{create_date}.json'],
+                           ['csv-script/tests/example.csv'])) == []
+    deltas = build_diff([f'payout_{create_date}.json'],
+                        ['csv-script/tests/example_changed.csv'])
+    file_path = write_diff_to_file(deltas, 'csv', str(tmp_path))
+    with open(file_path, mode='r') as file:
+        lines = file.read().splitlines()
+    assert lines[0] == ('record,change,department,email,name,rate,old_rate,'
+                        'hours,hours_delta,payout,payout_delta')
+    assert lines[3] == ('staff,added,Sales,ann@example.com,Ann Smith,'
+                        '50.0,,100,100,5000.0,5000.0')
+
+
+def test_main_diff_summary(tmp_path, monkeypatch, capsys):
+    old_file = os.path.abspath('csv-script/tests/example.csv')
+    new_file = os.path.abspath('csv-script/tests/example_changed.csv')
+    monkeypatch.chdir(tmp_path)
+    with patch('sys.argv', ['main.py', new_file, '--diff', old_file]):
+        asyncio.run(main())
+    assert capsys.readouterr().out.splitlines()[1:] == [
+        '| record     | change       | count |',
+        '| staff      | changed      | 1     |',
+        '| staff      | rate_changed | 1     |',
+        '| staff      | added        | 1     |',
+        '| staff      | removed      | 1     |',
+        '| department | changed      | 2     |',
+        '| department | added        | 1     |'
+    ]
+    create_date = datetime.now(timezone.utc).strftime(date_time_format)
+    with open(f'diff_{create_date}.jsonl', mode='r') as file:
+        deltas = [json.loads(line) for line in file]
+    assert len(deltas) == 7
+    assert deltas[2]['email'] == 'ann@example.com'
+
+
+def test_diff_with_broken_report(tmp_path, capsys):
+    truncated_report = tmp_path / 'truncated.json'
+    truncated_report.write_text('{"payout": [{"department": "HR"')
+    incomplete_report = tmp_path / 'incomplete.json'
+    incomplete_report.write_text('{"payout": [{"department": "HR", '
+                                 '"staff": []}]}')
+    new_files = ['csv-script/tests/example.csv']
+    assert build_diff([str(truncated_report)], new_files) is None
+    assert 'is not a valid JSON report' in capsys.readouterr().out
+    assert build_diff([str(incomplete_report)], new_files) is None
+    assert 'is not a complete payout report' in capsys.readouterr().out
+
+
+def test_pivot_group_by_with_top():
+    raw_table = asyncio.run(read_data_from_data_files(
+        ['csv-script/tests/example.csv',
+         'csv-script/tests/example_changed.csv']
+    ))
+    group_by = parse_group_by('devision,full_name')
+    assert group_by == ['department', 'name']
+    with pytest.raises(ReportError):
+        parse_group_by('department,foo')
+    with pytest.raises(ReportError):
+        parse_group_by([])
+    name_pivot = PivotAggregator(group_by)
+    department_pivot = PivotAggregator(['department'], top=2)
+    for row in raw_table[1:]:
+        name_pivot.append(row)
+        department_pivot.append(row)
+    assert name_pivot.to_dict_list()[1] == {
+        'department': 'Marketing', 'name': 'Bob Dylan',
+        'total_hours': 480, 'payout': 16080.0, 'average_rate': 33.5
+    }
+    group_dict_list = department_pivot.to_dict_list()
+    assert group_dict_list[1]['top'] == [
+        {'id': 102, 'email': 'bob@example.com', 'name': 'Bob Dylan',
+         'hours': 480, 'rate': 33.5, 'payout': 16080.0},
+        {'id': 103, 'email': 'john@example.com', 'name': 'John Dylan',
+         'hours': 190, 'rate': 45.0, 'payout': 8550.0}
+    ]
+    assert pivot_table(group_dict_list, ['department'], 2) == [
+        ['department', 'total_hours', 'payout', 'average_rate',
+         'top', 'email', 'name', 'payout'],
+        ['HR', 330, 14850.0, 45.0, 1, 'grace@example.com', 'Grace Lee',
+         14850.0],
+        ['Marketing', 670, 24630.0, 36.76, 1, 'bob@example.com',
+         'Bob Dylan', 16080.0],
+        ['', '', '', '', 2, 'john@example.com', 'John Dylan', 8550.0],
+        ['Sales', 100, 5000.0, 50.0, 1, 'ann@example.com', 'Ann Smith',
+         5000.0]
+    ]
+    rate_pivot = PivotAggregator(['department'], top=1, by='rate')
+    for row in raw_table[1:]:
+        rate_pivot.append(row)
+    assert rate_pivot.to_dict_list()[1]['top'][0]['email'] == \
+        'john@example.com'
+
+
+def test_report_engine_pivot():
+    report = ReportEngine().pivot('csv-script/tests/example.csv',
+                                  group_by=['department'],
+                                  top=1,
+                                  by='hours')
+    assert report.data['pivot'][1]['top'][0]['name'] == 'Bob Dylan'
+    alias_report = ReportEngine().pivot('csv-script/tests/example.csv',
+                                        group_by=['devision', 'full_name'])
+    assert alias_report.table[0][:2] == ['department', 'name']
+    with pytest.raises(ValueError):
+        ReportEngine().pivot('csv-script/tests/example.csv',
+                             group_by=['foo'])
+    with pytest.raises(ValueError):
+        ReportEngine().pivot('csv-script/tests/example.csv',
+                             group_by=['department'],
+                             top=0)
+    rate_report = ReportEngine().pivot('csv-script/tests/example.csv',
+                                       group_by=['rate'])
+    assert 45.0 in [group['rate'] for group in rate_report.data['pivot']]
+    assert 4500 not in [row[0] for row in rate_report.table]
+
+
+def test_pivot_group_by_hours():
+    rows = [['department', 'id', 'email', 'name', 'hours', 'rate'],
+            ['HR', 1, 'ann@example.com', 'Ann Smith', 10, 6],
+            ['HR', 2, 'bob@example.com', 'Bob Dylan', 10, 6],
+            ['Sales', 3, 'john@example.com', 'John Dylan', 20, 1]]
+    report = ReportEngine().pivot(rows, group_by=['hours'])
+    assert report.table == [['hours', 'total_hours', 'payout',
+                             'average_rate'],
+                            [10, 20, 120.0, 6.0],
+                            [20, 20, 20.0, 1.0]]
+    department_report = ReportEngine().pivot(
+        rows, group_by=['department', 'hours']
+    )
+    assert department_report.data['pivot'] == [
+        {'department': 'HR', 'hours': 10, 'total_hours': 20,
+         'payout': 120.0, 'average_rate': 6.0},
+        {'department': 'Sales', 'hours': 20, 'total_hours': 20,
+         'payout': 20.0, 'average_rate': 1.0}
+    ]
+
+
+def test_main_rejects_pivot_with_report(tmp_path, monkeypatch, capsys):
+    data_file = os.path.abspath('csv-script/tests/example.csv')
+    monkeypatch.chdir(tmp_path)
+    for options in (['--report', 'average-rate'],
+                    ['--max-memory', '1'],
+                    ['--checkpoint-dir', str(tmp_path / 'state')]):
+        with patch('sys.argv', ['main.py', data_file, '--top', '1',
+                                *options]):
+            asyncio.run(main())
+        assert capsys.readouterr().out == (
+            '--group-by and --top can not be used with '
+            '--report, --max-memory and --checkpoint-dir\n'
+        )
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize('max_memory', [3000, None])
+def test_resume_from_checkpoint(tmp_path, max_memory):
+    rows = staff_rows()
+    data_files = []
+    for part in range(3):
+        data_file = tmp_path / f'data{part}.csv'
+        data_file.write_text('\n'.join(
+            ','.join(map(str, row))
+            for row in [rows[0], *rows[1 + part * 200:201 + part * 200]]
+        ) + '\n')
+        data_files.append(str(data_file))
+    expected = ReportEngine().run(*data_files, operation='payout').data
+    state_dir = str(tmp_path / 'state')
+    parse_data_row = main_module.parse_data_row
+    parsed_rows = []
+    interrupt_after = [290]
+
+    def interrupted_parse(*args):
+        if len(parsed_rows) == interrupt_after[0]:
+            raise InterruptedError
+        parsed_rows.append(args)
+        return parse_data_row(*args)
+
+    with patch('main.parse_data_row', interrupted_parse):
+        with pytest.raises(InterruptedError):
+            aggregate_with_checkpoints(data_files, 'payout', state_dir,
+                                       checkpoint_every=50,
+                                       max_memory=max_memory)
+    checkpoint = read_checkpoint(state_dir)
+    assert checkpoint['completed_files'] == [data_files[0]]
+    assert checkpoint['row_number'] == 50
+    # Группы сброшены на диск, в контрольной точке только размеры частей
+    assert 'groups' not in checkpoint['aggregator']
+    parsed_rows.clear()
+    interrupt_after[0] = None
+    with patch('main.parse_data_row', interrupted_parse):
+        aggregator = aggregate_with_checkpoints(data_files, 'payout',
+                                                state_dir, resume=True,
+                                                checkpoint_every=50,
+                                                max_memory=max_memory)
+    assert len(parsed_rows) == 600 - 250
+    file_path = write_aggregated_report(aggregator, 'payout', str(tmp_path))
+    aggregator.close()
+    assert read_json_file(file_path) == expected
+
+
+def test_checkpoint_reading_matches_plain_reading(tmp_path, capsys):
+    crlf_file = tmp_path / 'crlf.csv'
+    crlf_file.write_bytes(
+        b'department,id,email,name,hours,rate\r\n'
+        b'HR,101,grace@example.com,Grace Lee,160,45\r\n'
+    )
+    expected = ReportEngine().run(str(crlf_file), operation='payout').data
+    aggregator = aggregate_with_checkpoints([str(crlf_file)], 'payout',
+                                            str(tmp_path / 'state'))
+    file_path = write_aggregated_report(aggregator, 'payout', str(tmp_path))
+    aggregator.close()
+    assert read_json_file(file_path) == expected
+    latin_file = tmp_path / 'latin.csv'
+    latin_file.write_bytes(
+        b'department,id,email,name,hours,rate\n'
+        b'HR,101,grace@example.com,Gr\xe2ce Lee,160,45\n'
+    )
+    with pytest.raises(ReportError, match='should be utf-8 text'):
+        ReportEngine().run(str(latin_file), operation='payout')
+    assert aggregate_with_checkpoints([str(latin_file)], 'payout',
+                                      str(tmp_path / 'latin_state')) is None
+    assert 'should be utf-8 text' in capsys.readouterr().out
+
+
+def test_no_resume_after_data_file_change(tmp_path, capsys):
+    data_file = tmp_path / 'data.csv'
+    with open('csv-script/tests/example.csv', mode='r') as file:
+        data_file.write_text(file.read())
+    state_dir = str(tmp_path / 'state')
+    aggregator = aggregate_with_checkpoints([str(data_file)], 'payout',
+                                            state_dir, checkpoint_every=1)
+    aggregator.close()
+    with open(data_file, mode='a') as file:
+        file.write('HR,104,ann@example.com,Ann Smith,10,50\n')
+    assert aggregate_with_checkpoints([str(data_file)], 'payout',
+                                      state_dir, resume=True) is None
+    assert 'Data files have changed' in capsys.readouterr().out
+
+
+def test_fixed_point_money():
+    assert parse_money('45') == 4500
+    assert parse_money('32.125') == 3213
+    assert parse_money('0.1', 4) == 1000
+    assert format_money(1999) == 19.99
+    assert divide_money(1623000, 430) == 3774
+    assert divide_money(5, 2) == 3
+    with pytest.raises(ValueError):
+        parse_money('nan')
+    rows = [['department', 'id', 'email', 'name', 'hours', 'rate']]
+    rows += [['HR', number, f'staff{number}@example.com', 'Staff Name',
+              1, '0.1'] for number in range(10)]
+    report = ReportEngine().run(rows, operation='average-rate')
+    assert report.data['average-rate'][0]['payout'] == 1.0
+    assert report.data['average-rate'][0]['average_rate'] == 0.1
+    reversed_report = ReportEngine().run([rows[0], *rows[:0:-1]],
+                                         operation='payout')
+    assert reversed_report.data['payout'][0]['payout'] == 1.0
+    rows[1][5] = '0.12345'
+    scaled_report = ReportEngine(money_scale=4).run(rows,
+                                                    operation='average-rate')
+    assert scaled_report.data['average-rate'][0]['average_rate'] == 0.1024
+    assert format_money(1999) == 19.99
+    assert parse_money('0.1234', 3) == 123
+    assert format_money(123, 3) == 0.123
+    with pytest.raises(ValueError):
+        ReportEngine(money_scale=-1)
+
+
+def test_report_engines_with_different_scales_in_threads():
+    rows = [['department', 'id', 'email', 'name', 'hours', 'rate']]
+    rows += [['HR', number, f'staff{number}@example.com', 'Staff Name',
+              10, '20'] for number in range(10)]
+
+    def run_report(money_scale: int) -> list:
+        engine = ReportEngine(money_scale=money_scale)
+        return [engine.run(rows, operation='payout')
+                .data['payout'][0]['payout'] for _ in range(50)]
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        cents = executor.submit(run_report, 2)
+        units = executor.submit(run_report, 4)
+        assert set(cents.result()) == {2000.0}
+        assert set(units.result()) == {2000.0}
+
+
+def test_hyperloglog_middle_range_bias():
+    errors = []
+    for trial in range(10):
+        sketch = HyperLogLog()
+        for number in range(10000):
+            sketch.add(f'staff{trial}-{number}@example.com')
+        errors.append(sketch.count() / 10000 - 1)
+    assert abs(sum(errors) / len(errors)) < 0.01
+
+
+def test_report_engine_approximate_stats(tmp_path, monkeypatch, capsys):
+    report = ReportEngine().run('csv-script/tests/example.csv',
+                                'csv-script/tests/example_changed.csv',
+                                operation='approximate-stats')
+    assert report.table[1:] == [['HR', 1, 45.0, 45.0],
+                                ['Marketing', 2, 35.0, 45.0],
+                                ['Sales', 1, 50.0, 50.0]]
+    data_file = os.path.abspath('csv-script/tests/example.csv')
+    monkeypatch.chdir(tmp_path)
+    with patch('sys.argv', ['main.py', data_file,
+                            '--report', 'approximate-stats']):
+        asyncio.run(main())
+    assert capsys.readouterr().out.splitlines()[1] == (
+        '| HR         | 1              | 45.0        | 45.0     |'
+    )